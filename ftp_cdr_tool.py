@@ -1,9 +1,131 @@
-import gzip
+import csv
 import json
+import logging
 import os
+import re
 import sys
-import time
-from ftplib import FTP_TLS
+import threading
+import zlib
+from ftplib import FTP_TLS, all_errors, error_perm
+from Queue import Queue, Empty
+try:
+    from ujson import loads as json_loads#optional, parses the CDRs several times faster than the json module
+except ImportError:
+    from json import loads as json_loads
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir#optional backport of os.scandir, reads file sizes with the directory listing on Windows
+    except ImportError:
+        scandir = None
+
+class CDRStream(object):
+    """
+    Collects the CDRs out of a log file while it is being downloaded:
+        -buffers the downloaded data into blocks of block_size bytes
+        -gunzips each block if the log file is a .gz
+        -keeps any partial last line until the rest of it arrives
+        -parses each "Submitting CDR [text=" line into self.CDRs
+        -tracks complete_size, the file offset just past the last complete line it parsed
+        -only parses an unterminated last line of a .txt if it is a complete CDR, or if final (the file is no longer written to)
+    """
+    
+    marker = "Submitting CDR [text="#start of every log line holding a CDR
+    
+    #FTP hands over small chunks, decompressing and scanning them in larger blocks is much cheaper
+    block_size = 128 * 1024
+    
+    def __init__(self, gzipped, offset=0, final=False):
+        self.gzipped = gzipped
+        self.final = final or gzipped#archives are never written to again
+        self.fed_size = offset#file offset of the end of the downloaded data, offset is where a resumed download starts
+        self.complete_size = offset
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None #16 + MAX_WBITS expects a gzip header
+        self.pending = []#downloaded chunks not yet processed
+        self.pending_size = 0
+        self.residual = ""#partial last line from the previous block
+        self.CDRs = []
+    
+    
+    def decompress(self, data):
+        """
+        gunzips data, starting a new decompressor for each concatenated gzip member
+            -skips zero padding after a member, like the gzip module does
+        """
+        out = self.decompressor.decompress(data)
+        data = self.decompressor.unused_data.lstrip("\0")#unused_data keeps growing once a member has ended
+        while len(data) > 0:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out += self.decompressor.decompress(data)
+            data = self.decompressor.unused_data.lstrip("\0")
+        return out
+    
+    
+    def feed(self, data):
+        """
+        FTP retrbinary callback, processes the buffered data once a full block has arrived
+        """
+        self.pending.append(data)
+        self.pending_size += len(data)
+        self.fed_size += len(data)
+        if self.pending_size >= self.block_size:
+            self.process()
+    
+    
+    def process(self):
+        """
+        scans the complete lines in the buffered data for CDRs
+        """
+        data = "".join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        if self.gzipped:
+            data = self.decompress(data)
+        data = self.residual + data
+        end = data.rfind("\n") + 1
+        self.residual = data[end:]
+        self.scan(data, end)
+        if not self.gzipped:
+            self.complete_size = self.fed_size - len(self.residual)
+    
+    
+    def close(self):
+        """
+        scans whatever is left once the download has finished
+        """
+        self.process()
+        if self.gzipped:
+            self.residual += self.decompressor.flush()
+        if self.final:
+            self.scan(self.residual, len(self.residual))
+            self.complete_size = self.fed_size
+        elif self.residual.find(self.marker) != -1 and self.residual.rstrip().endswith("]"):
+            #a .txt log may still be written to, only take its unterminated last line if it holds a whole CDR
+            try:
+                self.scan(self.residual, len(self.residual))
+                self.complete_size = self.fed_size
+            except ValueError:
+                pass#cut off inside the JSON, it is parsed on a later sync once it is complete
+        self.residual = ""
+    
+    
+    def scan(self, data, end):
+        """
+        parses the CDR lines in data[:end] without splitting it into lines
+            -only searches for the marker, the line end is only searched for on CDR lines
+        """
+        marker = self.marker
+        index = data.find(marker, 0, end)
+        while index != -1:
+            line_end = data.find("\n", index, end)
+            if line_end == -1:
+                line_end = end
+            cdr_str = data[index + len(marker):line_end].rstrip()[:-1]#remove white space, new lines and the last "]" char from the [text=, in order to make JSON
+            cdr_dict = json_loads(cdr_str)
+            self.CDRs.append(cdr_dict["call"])
+            index = data.find(marker, line_end, end)
+
 
 class DLRTool(object):
     """
@@ -11,8 +133,8 @@ class DLRTool(object):
         -downloads all .txt and .gz log files from FTP site (ftp.tropo.com)
             *only if the file has updated/changed size since last download
             *downloads to local_working_dir
-        -extracts the *.gz files, still in local_working_dir
-        -parses the .txt files for CDRs (DLRs)
+        -parses the log files for CDRs (DLRs) while they download
+            *the .gz files are extracted in memory, no .txt copy is written
             *cleans the CDR for human readability 
         -writes the new parsed file to the local_dir
         -optionally create a CSV file if passed in at command line:
@@ -55,7 +177,7 @@ class DLRTool(object):
         }
         
     #Less frequently desired attributes commented out below.
-    CDRAttributes = [
+    CDRAttributes = (
         "AccountID",
         "ApplicationId",
         #"ApplicationType",
@@ -88,9 +210,17 @@ class DLRTool(object):
         "StartTime",
         #"StartUrl",
         "Status",
-        "StatusCode"]
+        "StatusCode")
+    
+    #Used for comparing CDR dates like "Mon, 12 Oct 2015 18:04:22 +0000", much faster than time.strptime
+    #Also matches the dates in CSVs from older versions of this tool, where the "," was replaced by a " "
+    datePattern = re.compile(r"\s*[A-Za-z]+,?\s+(\d{1,2})\s+([A-Za-z]{3})\s+(\d{4})\s+(\d{1,2}):(\d{1,2}):(\d{1,2})\s+\+0000\s*$")
+    months = {"Jan":1, "Feb":2, "Mar":3, "Apr":4, "May":5, "Jun":6, "Jul":7, "Aug":8, "Sep":9, "Oct":10, "Nov":11, "Dec":12}
+    
+    #Read size for FTP downloads and write buffer for the downloaded files, the 8KB default costs a recv and write call per 8KB
+    ftpBlockSize = 1 << 20
         
-    def __init__(self, host, username, password, output_csv=None, remote_dir="logs", local_working_dir="workinglogs", local_dir="parsedlogs", logging=True):
+    def __init__(self, host, username, password, output_csv=None, remote_dir="logs", local_working_dir="workinglogs", local_dir="parsedlogs", logging=True, ftp_connections=4):
         self.hostname = host #FTP hostname to download log files from, like "ftp.tropo.com"
         self.username = username #FTP username
         self.password = password #FTP password
@@ -99,6 +229,7 @@ class DLRTool(object):
         self.local_working_dir = local_working_dir#local directory where log files stored prior to processing
         self.local_dir = local_dir #Final parsed log file destination
         self.needed_files = []
+        self.ftp_connections = ftp_connections #number of parallel FTP sessions used to download needed_files
         
         if not os.path.exists(self.local_working_dir):
             os.makedirs(self.local_working_dir)#create the local directory if it does not exist
@@ -108,153 +239,371 @@ class DLRTool(object):
             self.csv = output_csv
             csv_path = os.path.split(output_csv)
             if len(csv_path[0]) > 0 and not os.path.exists(csv_path[0]):
-                os.path.makedirs(csv_path[0])
+                os.makedirs(csv_path[0])
+            if not os.path.exists(self.csv):
+                #If the CSV does not exist, need to create it and write the headers
+                with open(self.csv, "wb") as csv_f:
+                    csv.writer(csv_f, lineterminator="\n").writerow(self.CDRAttributes)
         else:
             self.csv = None
             
-        self.stored_files_list = os.listdir(self.local_working_dir)
+        self.local_sizes = self.get_local_sizes()#file name -> size of every file already in local_working_dir
+        self.index_file = os.path.join(self.local_working_dir, ".sync_index.json")#remembers which FTP files were already parsed
+        self.index = self.load_index()
+        self.remote_files = {}#file name -> [size, mtime] from the FTP LIST
+        self.resume_offsets = {}#file name -> parsed size, for needed_files that only grew since they were parsed
+        self.final_files = set()#needed_files whose FTP modification time has not changed since they were last parsed
         self.logging = logging
+        self.log = self.get_logger(logging)
         self.date_field = "DateCreated"#Could potentially be DateUpdated, StartTime, EndTime
+        self.parsed_dates = {}#date string -> comparable tuple, see parse_date
+        #(attribute, translation lookup or None) for each CDR attribute, so parse does not compare attribute names per CDR
+        #the lookups will attempt to get the pretty name for a code, and use the code if not found
+        translations = {"StatusCode": self.statusCodes.get, "ResponseCode": self.responseCodes.get}
+        self.attribute_plan = tuple((attr, translations.get(attr)) for attr in self.CDRAttributes)
         if self.csv != None:
             self.date_compare_index = self.CDRAttributes.index(self.date_field)#let this fail for csvs if no date to compare
+            self.last_csv_date_time = self.last_csv_date()#kept up to date by append_csv
         else:
             self.date_compare_index = -1
     
     
+    def get_logger(self, enabled):
+        """
+        Returns a logger for this DLRTool, printing to stdout through the shared "dlr" logger
+            -info messages are only printed if enabled
+            -the level is set on a child logger per DLRTool, so several DLRTools do not change each other's level
+        """
+        parent = logging.getLogger("dlr")
+        if len(parent.handlers) == 0:#only add the handler once, even with several DLRTools
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            parent.addHandler(handler)
+            parent.propagate = False
+        log = parent.getChild(str(id(self)))
+        log.setLevel(logging.INFO if enabled else logging.WARNING)
+        return log
+    
+    
+    def load_index(self):
+        """
+        Loads the sync index, {file name: [parsed size, mtime]} of every FTP file parsed by a previous run
+            -the parsed size of a .txt file stops at its last complete line, it may have been written to while downloading
+        """
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file) as f:
+            return json.load(f)
+    
+    
+    def save_index(self):
+        """
+        Writes the sync index to a temporary file first, so a crash can never leave a half written index
+        """
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f)
+        if os.name == "nt" and os.path.exists(self.index_file):
+            os.remove(self.index_file)#rename does not replace existing files on Windows
+        os.rename(tmp_file, self.index_file)
+    
+    
+    def get_local_sizes(self):
+        """
+        Lists local_working_dir once, with the size of each file
+        """
+        if scandir != None:
+            return dict((entry.name, entry.stat().st_size) for entry in scandir(self.local_working_dir))
+        sizes = {}
+        for file_name in os.listdir(self.local_working_dir):
+            sizes[file_name] = os.path.getsize(os.path.join(self.local_working_dir, file_name))
+        return sizes
+    
+    
     def get_file_attrs(self, ftp_file_str):
         """
-        Determines the FTP file name and file size from a
+        Determines the FTP file name, file size and modification time from a
         RETR command return line
         """
         file_attrs = ftp_file_str.split()
         name = file_attrs[len(file_attrs)-1] #return last item, which is the file name
         size = int(file_attrs[len(file_attrs)-5]) #return fifth to last item, which is the file size in bytes
-        return name, size
+        mtime = " ".join(file_attrs[len(file_attrs)-4:len(file_attrs)-1]) #return the three items before the name, like "Oct 15 10:20"
+        return name, size, mtime
     
     
     def ftp_list_callback(self, file_line):
         """
         determines the needed_files from an FTP RETR command
-            -uses the FTP file size information
-            -compares against local file size on disk
+            -skips files whose FTP size and modification time match the sync index
+            -for files not in the index, compares the FTP file size against local file size on disk
+            (only before the first indexed sync, after that a file on disk that is not in the index was never parsed)
             -downloads and replaces file on disk if different.
+            -only downloads the part of .txt files after their last parsed line
         """
-        file_name, file_size = self.get_file_attrs(file_line)
-        if file_name not in self.stored_files_list:
-            if self.logging:
-                print "file {0} missing, adding to list".format(file_name)
+        file_name, file_size, file_mtime = self.get_file_attrs(file_line)
+        self.remote_files[file_name] = [file_size, file_mtime]
+        if self.index.get(file_name) == [file_size, file_mtime]:
+            return
+        if file_name in self.index:
+            parsed_size = self.index[file_name][0]
+            if self.index[file_name][1] == file_mtime:
+                self.final_files.add(file_name)#no longer written to, so its unterminated last line is complete
+            if not file_name.endswith(".gz") and self.local_sizes.get(file_name, -1) >= parsed_size and file_size > parsed_size:
+                #log files are only appended to, so the parsed part does not need to be downloaded again
+                self.log.info("file %s has %d bytes past its last parsed line, adding to list", file_name, file_size - parsed_size)
+                self.resume_offsets[file_name] = parsed_size
+            else:
+                self.log.info("file %s changed on FTP since it was last parsed, adding to list", file_name)
+            self.needed_files.append(file_name)
+        elif file_name not in self.local_sizes:
+            self.log.info("file %s missing, adding to list", file_name)
+            self.needed_files.append(file_name)
+        elif len(self.index) > 0:
+            self.log.info("file %s was never parsed, adding to list", file_name)
             self.needed_files.append(file_name)
         else:
-            file_size_on_disk = os.path.getsize(os.path.join(self.local_working_dir, file_name)) 
+            file_size_on_disk = self.local_sizes[file_name]
             if file_size != file_size_on_disk:
-                if self.logging:
-                    print "file {0} FTP size {1} does not equal {2} size on disk, adding to list".format(file_name, file_size, file_size_on_disk)
+                self.log.info("file %s FTP size %d does not equal %d size on disk, adding to list", file_name, file_size, file_size_on_disk)
                 self.needed_files.append(file_name)
                 
     
-    def sync(self):
+    def connect(self):
         """
-        downloads all needed_files from self.hostname (FTP)
-        of the downloaded files, extracts .gz files to same local_working_dir
-            -using self.extract function
-        parses the .txt downloaded needed_files
-            -using the self.parse function
+        opens a new FTP_TLS session to self.hostname, logged in and in self.remote_dir
         """
         ftps = FTP_TLS(self.hostname) # connect to host, default port
         ftps.login(self.username, self.password)
         ftps.prot_p()
         ftps.cwd(self.remote_dir) # change into "logs" directory
+        return ftps
+    
+    
+    def open_session(self):
+        """
+        opens a new FTP session for a download worker, using self.connect
+            -returns None if the server refuses it, like "421 Too many connections"
+        """
+        try:
+            return self.connect()
+        except all_errors as e:
+            self.log.warning("could not open another FTP session, continuing with fewer: %s", e)
+            return None
+    
+    
+    def download_worker(self, file_queue, downloaded, finished, failed):
+        """
+        downloads files from file_queue over its own FTP session until the queue is empty
+            -collects the CDRs of each file while it downloads, using CDRStream
+            -stores the CDRStream of each downloaded file in the downloaded dict, or None if the download failed
+            -notifies the finished condition after each file
+            -logs a failed file and sets the failed event, sync does not parse the files after it so all workers stop
+            -exits without downloading anything if its FTP session can not be opened, the other workers drain the queue
+        """
+        ftps = self.open_session()
+        if ftps == None:
+            return
+        try:
+            while not failed.is_set():
+                try:
+                    needed_file = file_queue.get_nowait()
+                except Empty:
+                    break
+                self.log.info("Writing %s to %s...", needed_file, self.local_working_dir)
+                stream = None
+                try:
+                    offset = self.resume_offsets.get(needed_file, 0)
+                    if offset > 0:
+                        try:
+                            stream = self.download(ftps, needed_file, offset)
+                        except error_perm:
+                            self.log.info("could not resume %s, downloading all of it", needed_file)
+                            del self.resume_offsets[needed_file]
+                    if stream == None:
+                        stream = self.download(ftps, needed_file, 0)
+                except Exception as e:
+                    self.log.warning("failed to download %s: %s", needed_file, e)
+                    failed.set()
+                with finished:
+                    downloaded[needed_file] = stream
+                    finished.notify()
+        finally:
+            ftps.close()
+    
+    
+    def download(self, ftps, needed_file, offset):
+        """
+        downloads needed_file to local_working_dir and returns the CDRStream that collected its CDRs
+            -if offset is not 0, only downloads from offset on (FTP REST) and appends to the local file
+            -when resuming, the local file is cut back to offset first, dropping the unterminated last line of the previous download
+        """
+        stream = CDRStream(needed_file.endswith(".gz"), offset, needed_file in self.final_files)
+        with open(os.path.join(self.local_working_dir, needed_file), 'r+b' if offset > 0 else 'wb', self.ftpBlockSize) as f:
+            if offset > 0:
+                f.truncate(offset)
+                f.seek(offset)
+            def write_and_feed(data):
+                f.write(data)
+                stream.feed(data)
+            ftps.retrbinary("RETR " + needed_file, write_and_feed, self.ftpBlockSize, offset if offset > 0 else None)
+        stream.close()
+        return stream
+    
+    
+    def sync(self):
+        """
+        downloads all needed_files from self.hostname (FTP)
+            -using up to self.ftp_connections parallel FTP sessions
+            -collecting the CDRs of each file as it downloads
+        writes out the CDRs of each needed_file as soon as it is downloaded, in LIST order
+            -using the self.parse function
+            -stops at the first file that failed to download, the CSV only takes CDRs newer than its last row
+            so the files after it are left out of the CSV and index, and redone on the next run
+        """
+        ftps = self.connect()
         ftps.retrlines('LIST *.gz *.txt', self.ftp_list_callback) # list directory contents
+        ftps.quit()
+        
+        file_queue = Queue()
         for needed_file in self.needed_files:
-            if self.logging:
-                print "Writing {0} to {1}...".format(needed_file, self.local_working_dir)
-            ftps.retrbinary("RETR " + needed_file, open(os.path.join(self.local_working_dir, needed_file), 'wb').write)
-        if self.logging:
-            print "done syncing files"
+            file_queue.put(needed_file)
+        downloaded = {}
+        finished = threading.Condition()
+        failed = threading.Event()
+        workers = []
+        for i in range(min(self.ftp_connections, len(self.needed_files))):
+            worker = threading.Thread(target=self.download_worker, args=(file_queue, downloaded, finished, failed))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        failed_file = None
         for needed_file in self.needed_files:
-            if needed_file.endswith(".gz"):
-                self.extract(os.path.join(self.local_working_dir, needed_file))
+            with finished:
+                while needed_file not in downloaded and any(worker.is_alive() for worker in workers):
+                    finished.wait(1)#the timeout notices workers that exited without downloading the file
+                if needed_file not in downloaded and failed_file == None:
+                    self.log.warning("no FTP session left to download %s, skipping", needed_file)
+                stream = downloaded.pop(needed_file, None)
+            if stream == None:#the worker already logged why the download failed
+                if failed_file == None:
+                    failed_file = needed_file
+                continue
+            if failed_file != None:
+                self.log.info("not parsing %s until %s is synced, it will be redone on the next run", needed_file, failed_file)
+                continue
             txt_file_name = needed_file.replace('.gz','')#if already a .txt file, this is unnceccessary but works.
-            self.parse(txt_file_name)
-        if self.logging:
-            print "done extracting/parsing .gz files"
-        ftps.quit()
+            self.parse(txt_file_name, stream.CDRs, needed_file in self.resume_offsets)
+            self.index[needed_file] = [stream.complete_size, self.remote_files[needed_file][1]]
+            self.save_index()
+        for worker in workers:
+            worker.join()
+        if failed_file != None:
+            self.log.warning("could not sync %s, it and the files after it will be synced on the next run", failed_file)
+        else:
+            self.log.info("done syncing and parsing files")
     
     
-    def extract(self, file_name):
+    def parse_date(self, date_str):
         """
-        Function extracts file_name with .gz extension into same directory as .gz file_name
+        Converts a CDR date string into a (year, month, day, hour, minute, second) tuple
+            -tuples compare in date order
+            -results are cached, CDRs in the same second share the same date string
         """
-        out_file_name = file_name.replace('.gz','')
-        if self.logging:
-            print "Extracting {0} to {1}...".format(file_name, out_file_name)
-        with gzip.open(file_name, 'rb') as infile:
-            with open(out_file_name, 'w') as outfile:
-                for line in infile:
-                    outfile.write(line)
+        date_time = self.parsed_dates.get(date_str)
+        if date_time == None:
+            match = self.datePattern.match(date_str)
+            if match == None or match.group(2).title() not in self.months:
+                raise ValueError("date {0!r} does not match the CDR date format".format(date_str))
+            day, month, year, hour, minute, second = match.groups()
+            date_time = (int(year), self.months[month.title()], int(day), int(hour), int(minute), int(second))
+            self.parsed_dates[date_str] = date_time
+        return date_time
     
     
-    def parse(self, file_name):
+    def last_csv_date(self):
         """
-        This function will parse all data in a specific prism log file entry and collect all CDRs for SMS messages and calls
+        Reads the date of the last dated row in self.csv
+            -reads the whole CSV once, so values containing line breaks are read as part of their row
+            -returns 0 if the CSV has no dated rows
+        """
+        last_date = None
+        with open(self.csv, "rb") as csv_r:
+            rows = csv.reader(csv_r)
+            next(rows, None)#skip the headers
+            for row in rows:
+                if len(row) > self.date_compare_index and len(row[self.date_compare_index]) > 0:
+                    last_date = row[self.date_compare_index]
+        if last_date == None:
+            return 0
+        return self.parse_date(last_date)
+    
+    
+    def parse(self, file_name, CDRs, append=False):
+        """
+        This function will write all CDRs collected from a specific prism log file entry for SMS messages and calls
+            -if append, the CDRs are added to the end of the parsed file instead of replacing it
+            -the new CDRs are then appended to the CSV, using self.append_csv
         """
-        results = []
-        CDRs = []
-        parse_file_name = os.path.join(self.local_working_dir, file_name)
         final_file_name = os.path.join(self.local_dir, file_name)
-        with open(parse_file_name) as f:
-            if self.logging:
-                print 'Parsing {0} and saving to {1}"'.format(file_name, final_file_name)
-            for line in f:
-                if "Submitting CDR [text=" in line:
-                    cdr_str = line.split("Submitting CDR [text=")[1].strip()#remove white space and new lines
-                    cdr_str = cdr_str[:len(cdr_str)-1]#remove the last "]" char from the [text=, in order to make JSON
-                    cdr_dict = json.loads(cdr_str)
-                    CDRs.append(cdr_dict["call"])
+        self.log.info('Parsing %s and saving to %s"', file_name, final_file_name)
         
-        if self.csv != None and not os.path.exists(self.csv):
-            #If the CSV does not exist, need to create it and write the headers
-            with open(self.csv, "w") as csv:
-                write_str = self.CDRAttributes[0]#this will break if no CDR attributes exist, but that seems silly to handle for
-                for attr in self.CDRAttributes[1:]:
-                    write_str += ","+attr   
-                csv.write(write_str+"\n")
-                
-        with open(final_file_name, "w") as out_f:
-            for cdr in CDRs:
-                tempDictionary = {}
-                for attr in self.CDRAttributes:
-                    if cdr.get(attr) != None:
-                        if attr == "StatusCode":
-                            tempDictionary.update({attr: self.statusCodes.get(cdr[attr], cdr[attr])})#.get(cdr[attr]... will attempt to get pretty name, and use code if not found
-                        elif attr == "ResponseCode":
-                            tempDictionary.update({attr: self.responseCodes.get(cdr[attr], cdr[attr])})#.get(cdr[attr]... will attempt to get pretty name, and use code if not found
-                        else:
-                            tempDictionary.update({attr: cdr[attr]})
-                write_str = tempDictionary[self.date_field] + " - "
-                write_str += json.dumps(tempDictionary)+"\n"
-                out_f.write(write_str)
-                if self.csv != None:
-                    with open(self.csv, "r") as csv_r:
-                        lines = csv_r.readlines()
-                        if len(lines) > 1:#if it's more than just headers
-                            last_line = lines[-1]# read the last line to compare times.
-                            last_line_list = last_line.split(',')
-                            last_date = last_line_list[self.date_compare_index]
-                            last_date_time = time.strptime(last_date, "%a  %d %b %Y %H:%M:%S +0000")
-                        else:
-                            last_date_time = 0
-                    this_date_time = None
-                    if tempDictionary.get(self.date_field, None) != None:
-                        this_date_time = time.strptime(tempDictionary[self.date_field].replace(","," "), "%a  %d %b %Y %H:%M:%S +0000")
-                    if this_date_time == None or this_date_time > last_date_time:
-                        with open(self.csv, "a") as csv:
-                            csv_write_str = ""
-                            for attr in self.CDRAttributes: # this could probably be a little faster if handled in the previous loop
-                                csv_write_str += str(tempDictionary.get(attr,"")).replace(","," ") + ","
-                            csv_write_str = csv_write_str.rstrip(',') + "\n"#remove trailing comma
-                            csv.write(csv_write_str)
-                        
+        attribute_plan = self.attribute_plan
+        date_field = self.date_field
+        dicts = []
+        parsed_rows = []
+        for cdr in CDRs:
+            cdr_get = cdr.get
+            tempDictionary = {}
+            for attr, translate in attribute_plan:
+                value = cdr_get(attr)
+                if value != None:
+                    if translate != None:
+                        value = translate(value, value)
+                    tempDictionary[attr] = value
+            dicts.append(tempDictionary)
+            write_str = tempDictionary[date_field] + " - "
+            write_str += json.dumps(tempDictionary)+"\n"
+            parsed_rows.append(write_str)
+        
+        with open(final_file_name, "a" if append else "w") as out_f:
+            out_f.writelines(parsed_rows)
+        if self.csv != None:
+            self.append_csv(dicts)
+    
+    
+    def append_csv(self, dicts):
+        """
+        Appends the parsed CDRs newer than the last row of the CSV, in date order
+            -CDRs without a date are always appended, after the dated ones
+        """
+        date_field = self.date_field
+        last_date_time = self.last_csv_date_time
+        dated = []
+        undated = []
+        for tempDictionary in dicts:
+            date_str = tempDictionary.get(date_field)
+            if date_str == None:
+                undated.append(tempDictionary)
+            elif self.parse_date(date_str) > last_date_time:
+                dated.append(tempDictionary)
+        if len(dated) + len(undated) == 0:
+            return
+        dated.sort(key=lambda tempDictionary: self.parsed_dates[tempDictionary[date_field]])#parse_date cached every date above
+        if len(dated) > 0:
+            self.last_csv_date_time = self.parsed_dates[dated[-1][date_field]]
+        
+        csv_rows = []
+        for tempDictionary in dated + undated:
+            row = []
+            for attr in self.CDRAttributes:
+                value = tempDictionary.get(attr, "")
+                if isinstance(value, unicode):
+                    value = value.encode("utf-8")#the csv module only writes byte strings
+                row.append(value)
+            csv_rows.append(row)
+        with open(self.csv, "ab") as csv_f:
+            csv.writer(csv_f, lineterminator="\n").writerows(csv_rows)#quotes values containing "," or line breaks
 
 
 if __name__ == "__main__":